@@ -1,59 +1,244 @@
 import asyncio
-import json
+import functools
+import logging
 import os
-from dataclasses import dataclass
-from typing import Dict, List, Optional
+import sys
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Set
 
 import aiohttp
-from aiogram import Bot, Dispatcher, F, types
+import orjson
+from cachetools import TTLCache
+from aiogram import Bot, Dispatcher, F, Router, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.methods import EditMessageReplyMarkup, EditMessageText, SendMessage
+from aiogram.methods.base import Response, TelegramMethod
+from aiogram.utils.chat_action import ChatActionMiddleware
 
 
+log = logging.getLogger(__name__)
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# старый единый файл пользователей; при старте переносится в шарды DATA_DIR
 DATA_FILE = "users.json"
 
-# -------------------- Storage --------------------
-def load_data() -> Dict[str, dict]:
-    if not os.path.exists(DATA_FILE):
-        return {}
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+# общая HTTP-сессия (keep-alive + пул соединений), создаётся в main()
+HTTP: Optional[aiohttp.ClientSession] = None
 
-def save_data(data: Dict[str, dict]) -> None:
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+async def to_thread(func, *args):
+    # asyncio.to_thread есть только с Python 3.9, aiogram же поддерживает и 3.8
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
 
-DATA: Dict[str, dict] = load_data()
+
+# -------------------- Storage --------------------
+# Снимок разбит на SHARD_COUNT файлов users/xx.json (шард = uid % SHARD_COUNT),
+# users.log.jsonl — журнал изменений после снимка (одна операция на строку).
+# При старте читаем шарды и проигрываем журнал; раз в COMPACT_EVERY секунд переписываем
+# только изменённые шарды и начинаем журнал заново. Операции идемпотентны, поэтому
+# повторное проигрывание безопасно.
+DATA_DIR = "users"
+SHARD_COUNT = 256
+LOG_FILE = "users.log.jsonl"
+LOG_OLD = LOG_FILE + ".old"
+LOG_BUFFER = 64 * 1024
+COMPACT_EVERY = 3600
+
+def _shard_index(uid: str) -> int:
+    return int(uid) % SHARD_COUNT
+
+def _shard_path(i: int) -> str:
+    return os.path.join(DATA_DIR, f"{i:02x}.json")
+
+def _replay(shards: List[Dict[str, dict]], ev: dict) -> None:
+    uid = ev["uid"]
+    u = shards[_shard_index(uid)].setdefault(uid, {"current": None, "favorites": []})
+    op = ev["op"]
+    if op == "set_current":
+        u["current"] = ev["city"]
+    elif op == "add_fav":
+        if not any(c["id"] == ev["city"]["id"] for c in u["favorites"]):
+            u["favorites"].append(ev["city"])
+    elif op == "remove_fav":
+        u["favorites"] = [c for c in u["favorites"] if c["id"] != ev["cid"]]
+
+def load_data() -> List[Dict[str, dict]]:
+    shards: List[Dict[str, dict]] = [{} for _ in range(SHARD_COUNT)]
+    # старый единый users.json: раскладываем по шардам и помечаем их к записи
+    if os.path.exists(DATA_FILE):
+        with open(DATA_FILE, "rb") as f:
+            for uid, u in orjson.loads(f.read()).items():
+                i = _shard_index(uid)
+                shards[i][uid] = u
+                _DIRTY_SHARDS.add(i)
+    for i in range(SHARD_COUNT):
+        path = _shard_path(i)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                shards[i].update(orjson.loads(f.read()))
+    # .old остаётся, если прошлое сжатие не успело дописать снимок
+    for path in (LOG_OLD, LOG_FILE):
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    ev = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # недописанная последняя строка после падения
+                    break
+                _replay(shards, ev)
+                # шард ещё не записан с этим событием: без пометки следующее сжатие
+                # удалит журнал, не переписав шард, и изменение потеряется
+                _DIRTY_SHARDS.add(_shard_index(ev["uid"]))
+    return shards
+
+def _write_json_atomic(path: str, payload: bytes) -> None:
+    # пишем во временный файл и подменяем — при падении старый файл останется целым
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+def _save_data_sync(dirty: Set[int]) -> None:
+    os.makedirs(DATA_DIR, exist_ok=True)
+    for i in dirty:
+        # orjson.dumps не отпускает GIL, так что снимок шарда получается целостным даже из потока
+        payload = orjson.dumps(SHARDS[i], option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        _write_json_atomic(_shard_path(i), payload)
+    if os.path.exists(DATA_FILE):
+        os.remove(DATA_FILE)
+    if os.path.exists(LOG_OLD):
+        os.remove(LOG_OLD)
+
+def _open_log():
+    return open(LOG_FILE, "ab", buffering=LOG_BUFFER)
+
+def _sync_log(f) -> None:
+    # BufferedWriter держит свой замок, так что цикл может дописывать в буфер параллельно
+    f.flush()
+    os.fsync(f.fileno())
+
+def _close_synced(f) -> None:
+    _sync_log(f)
+    f.close()
+
+def _rotate_log():
+    # если .old остался от неудачного сжатия, текущий журнал не трогаем —
+    # новый снимок всё равно покроет оба
+    if os.path.exists(LOG_OLD):
+        return None
+    # старый дескриптор продолжает писать в переименованный файл, пока его не закроют
+    os.replace(LOG_FILE, LOG_OLD)
+    return _open_log()
+
+# заполняется в main() через to_thread(load_data)
+SHARDS: List[Dict[str, dict]] = [{} for _ in range(SHARD_COUNT)]
+# шарды, изменившиеся с последнего сжатия
+_DIRTY_SHARDS: Set[int] = set()
+_LOG = None
+
+# записи копятся в буфере журнала, flusher() сбрасывает их на диск не чаще раза в FLUSH_DELAY секунд
+FLUSH_DELAY = 2.0
+# создаются в main(): на Python < 3.10 примитивы asyncio привязываются к циклу при создании
+_DIRTY: Optional[asyncio.Event] = None
+_save_lock: Optional[asyncio.Lock] = None
+
+def log_event(ev: dict) -> None:
+    _LOG.write(orjson.dumps(ev) + b"\n")
+    _DIRTY_SHARDS.add(_shard_index(ev["uid"]))
+    _DIRTY.set()
+
+async def save_data() -> None:
+    async with _save_lock:
+        _DIRTY.clear()
+        try:
+            await to_thread(_sync_log, _LOG)
+        except BaseException:
+            # не дописали — пусть следующий сброс повторит попытку
+            _DIRTY.set()
+            raise
+
+async def compact() -> None:
+    global _LOG
+    async with _save_lock:
+        _DIRTY.clear()
+        new_log = await to_thread(_rotate_log)
+        if new_log is not None:
+            old, _LOG = _LOG, new_log
+            await to_thread(_close_synced, old)
+        dirty = set(_DIRTY_SHARDS)
+        _DIRTY_SHARDS.clear()
+        try:
+            await to_thread(_save_data_sync, dirty)
+        except BaseException:
+            _DIRTY_SHARDS.update(dirty)
+            raise
+
+async def flusher() -> None:
+    while True:
+        await _DIRTY.wait()
+        await asyncio.sleep(FLUSH_DELAY)
+        # shield: отмена при остановке не должна обрывать запись на полпути
+        await asyncio.shield(save_data())
+
+async def compactor() -> None:
+    while True:
+        await asyncio.sleep(COMPACT_EVERY)
+        await asyncio.shield(compact())
+
+# id избранных городов по пользователю — O(1) проверка вместо прохода по списку;
+# держим отдельно от SHARDS, чтобы множества не попадали в файлы шардов
+FAV_IDS: Dict[str, Set[str]] = {}
 
 def get_user(user_id: int) -> dict:
+    # без записи в журнал: пустой профиль попадёт в снимок вместе со своим шардом,
+    # а первая же реальная операция создаст его при проигрывании (_replay)
+    uid = str(user_id)
+    shard = SHARDS[_shard_index(uid)]
+    u = shard.get(uid)
+    if u is None:
+        u = shard[uid] = {"current": None, "favorites": []}
+    return u
+
+def fav_ids(user_id: int) -> Set[str]:
     uid = str(user_id)
-    if uid not in DATA:
-        DATA[uid] = {"current": None, "favorites": []}
-        save_data(DATA)
-    return DATA[uid]
+    ids = FAV_IDS.get(uid)
+    if ids is None:
+        ids = FAV_IDS[uid] = {c["id"] for c in get_user(user_id)["favorites"]}
+    return ids
 
 def set_current(user_id: int, city: dict) -> None:
     u = get_user(user_id)
+    cur = u.get("current")
+    if cur and cur.get("id") == city["id"]:
+        return
     u["current"] = city
-    save_data(DATA)
+    log_event({"op": "set_current", "uid": str(user_id), "city": city})
 
 def add_fav(user_id: int, city: dict) -> None:
-    u = get_user(user_id)
-    favs = u["favorites"]
-    if not any(c["id"] == city["id"] for c in favs):
-        favs.append(city)
-        save_data(DATA)
+    ids = fav_ids(user_id)
+    if city["id"] in ids:
+        return
+    get_user(user_id)["favorites"].append(city)
+    ids.add(city["id"])
+    log_event({"op": "add_fav", "uid": str(user_id), "city": city})
 
 def remove_fav(user_id: int, city_id: str) -> None:
+    ids = fav_ids(user_id)
+    if city_id not in ids:
+        return
+    ids.discard(city_id)
     u = get_user(user_id)
     u["favorites"] = [c for c in u["favorites"] if c["id"] != city_id]
-    save_data(DATA)
+    log_event({"op": "remove_fav", "uid": str(user_id), "cid": city_id})
 
 
 # -------------------- Models --------------------
-@dataclass
+@dataclass(frozen=True)
 class City:
     id: str
     name: str
@@ -61,14 +246,15 @@ class City:
     admin1: str
     lat: float
     lon: float
+    _label: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        # город не меняется, поэтому подпись собираем один раз
+        label = ", ".join(p for p in (self.name, self.admin1, self.country) if p)
+        object.__setattr__(self, "_label", label)
 
     def label(self) -> str:
-        parts = [self.name]
-        if self.admin1:
-            parts.append(self.admin1)
-        if self.country:
-            parts.append(self.country)
-        return ", ".join(parts)
+        return self._label
 
 
 # -------------------- FSM --------------------
@@ -76,14 +262,20 @@ class PickCity(StatesGroup):
     waiting_city_name = State()
 
 
+# -------------------- Callback data --------------------
+class CityCB(CallbackData, prefix="c"):
+    # action: pick / favset / favdel; cid строкой — у точек геолокации id вида "lat,lon"
+    action: str
+    cid: str
+
+
 # -------------------- API helpers (Open-Meteo) --------------------
 async def geo_search(name: str, limit: int = 5) -> List[City]:
     url = "https://geocoding-api.open-meteo.com/v1/search"
     params = {"name": name, "count": limit, "language": "ru", "format": "json"}
-    async with aiohttp.ClientSession() as s:
-        async with s.get(url, params=params, timeout=20) as r:
-            r.raise_for_status()
-            data = await r.json()
+    async with HTTP.get(url, params=params) as r:
+        r.raise_for_status()
+        data = orjson.loads(await r.read())
 
     results = data.get("results") or []
     cities: List[City] = []
@@ -100,6 +292,8 @@ async def geo_search(name: str, limit: int = 5) -> List[City]:
         )
     return cities
 
+DAILY_FIELDS = ("temperature_2m_max", "temperature_2m_min", "precipitation_sum", "wind_speed_10m_max", "weathercode")
+
 async def forecast_daily(lat: float, lon: float, days: int) -> dict:
     # Open-Meteo: forecast_days максимум 16 для GFS. ([open-meteo.com](https://open-meteo.com/en/docs/gfs-api?utm_source=chatgpt.com))
     days = max(1, min(days, 16))
@@ -109,12 +303,62 @@ async def forecast_daily(lat: float, lon: float, days: int) -> dict:
         "longitude": lon,
         "timezone": "auto",
         "forecast_days": days,
-        "daily": "temperature_2m_max,temperature_2m_min,precipitation_sum,wind_speed_10m_max,weathercode",
+        "daily": ",".join(DAILY_FIELDS),
     }
-    async with aiohttp.ClientSession() as s:
-        async with s.get(url, params=params, timeout=20) as r:
-            r.raise_for_status()
-            return await r.json()
+    async with HTTP.get(url, params=params) as r:
+        r.raise_for_status()
+        data = orjson.loads(await r.read())
+
+    # оставляем только нужные дни — ответ потом живёт в FORECAST_CACHE
+    daily = data["daily"]
+    n = min(days, len(daily["time"]))
+    data["daily"] = {k: daily[k][:n] for k in ("time", *DAILY_FIELDS)}
+    return data
+
+# -------------------- API cache --------------------
+GEO_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=3600)
+FORECAST_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=1200)
+# одна задача на ключ: параллельные одинаковые запросы ждут один HTTP-вызов
+# и получают его результат или его же ошибку, без повторов по очереди
+_INFLIGHT: Dict[Hashable, asyncio.Task] = {}
+
+def _fetch_done(cache: TTLCache, key: Hashable, task: asyncio.Task) -> None:
+    _INFLIGHT.pop(key, None)
+    if task.cancelled():
+        return
+    # exception() заодно помечает ошибку как полученную, даже если все ждущие отменились
+    if task.exception() is None:
+        cache[key] = task.result()
+
+async def _cached(cache: TTLCache, key: Hashable, fetch: Callable[[], Awaitable]):
+    value = cache.get(key)
+    if value is not None:
+        return value
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = _INFLIGHT[key] = asyncio.ensure_future(fetch())
+        task.add_done_callback(lambda t: _fetch_done(cache, key, t))
+    # shield: отмена одного ждущего не должна обрывать запрос для остальных
+    return await asyncio.shield(task)
+
+async def geo_search_cached(name: str, limit: int = 5) -> List[City]:
+    key = ("geo", name.strip().lower(), limit)
+    return await _cached(GEO_CACHE, key, lambda: geo_search(name, limit))
+
+async def forecast_daily_cached(lat: float, lon: float, days: int) -> dict:
+    # округляем координаты, чтобы соседние точки геолокации попадали в один ключ
+    lat, lon = round(lat, 3), round(lon, 3)
+    days = max(1, min(days, 16))
+    key = ("forecast", lat, lon, days)
+    return await _cached(FORECAST_CACHE, key, lambda: forecast_daily(lat, lon, days))
+
+async def forecast_many(cities: List[dict], days: int) -> list:
+    # запросы независимы — ждём самый медленный, а не сумму всех (пул HTTP-сессии до 100 соединений);
+    # ошибка по одному городу возвращается на его месте, а не роняет весь список
+    return await asyncio.gather(
+        *(forecast_daily_cached(c["lat"], c["lon"], days) for c in cities),
+        return_exceptions=True,
+    )
 
 def format_daily(city_label: str, daily: dict, want_days: int, real_days: int) -> str:
     d = daily["daily"]
@@ -124,55 +368,62 @@ def format_daily(city_label: str, daily: dict, want_days: int, real_days: int) -
         lines.append(f"⚠️ Доступно только {real_days} дней (лимит источника прогноза).")
 
     lines.append("")
-    for i in range(min(real_days, len(d["time"]))):
-        date = d["time"][i]
-        tmin = d["temperature_2m_min"][i]
-        tmax = d["temperature_2m_max"][i]
-        pr = d["precipitation_sum"][i]
-        wind = d["wind_speed_10m_max"][i]
-        weather_code = d["weathercode"][i]
-        # Иконка погоды
-        weather_icon = f"https://open-meteo.com/assets/icons/{weather_code}.svg"
+    n = real_days
+    # массивы Open-Meteo идут по колонкам — обходим их параллельно через zip
+    for date, tmin, tmax, pr, wind in zip(
+        d["time"][:n],
+        d["temperature_2m_min"][:n],
+        d["temperature_2m_max"][:n],
+        d["precipitation_sum"][:n],
+        d["wind_speed_10m_max"][:n],
+    ):
         lines.append(f"{date}: {tmin}…{tmax}°C, осадки {pr} мм, ветер до {wind} м/с")
 
     return "\n".join(lines)
 
 
 # -------------------- Keyboards --------------------
-def main_kb() -> types.ReplyKeyboardMarkup:
-    return types.ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                types.KeyboardButton(text="🏙 Выбрать город"),
-                types.KeyboardButton(text="⭐ Избранные города"),
-            ],
-            [
-                types.KeyboardButton(text="🗓 Погода на неделю"),
-                types.KeyboardButton(text="📅 Погода на месяц"),
-            ],
-            [
-                types.KeyboardButton(text="📍 Отправить геолокацию", request_location=True),
-            ],
+# клавиатура статична — собираем один раз при импорте
+MAIN_KB = types.ReplyKeyboardMarkup(
+    keyboard=[
+        [
+            types.KeyboardButton(text="🏙 Выбрать город"),
+            types.KeyboardButton(text="⭐ Избранные города"),
         ],
-        resize_keyboard=True,
-        input_field_placeholder="Выберите действие…",
-    )
+        [
+            types.KeyboardButton(text="🗓 Погода на неделю"),
+            types.KeyboardButton(text="📅 Погода на месяц"),
+        ],
+        [
+            types.KeyboardButton(text="📍 Отправить геолокацию", request_location=True),
+        ],
+    ],
+    resize_keyboard=True,
+    input_field_placeholder="Выберите действие…",
+)
 
 def cities_inline_kb(cities: List[City]) -> types.InlineKeyboardMarkup:
     rows = []
     for c in cities:
-        rows.append([types.InlineKeyboardButton(text=c.label(), callback_data=f"pick:{c.id}")])
+        rows.append([types.InlineKeyboardButton(text=c.label(), callback_data=CityCB(action="pick", cid=c.id).pack())])
     return types.InlineKeyboardMarkup(inline_keyboard=rows)
 
 def fav_inline_kb(favs: List[dict]) -> types.InlineKeyboardMarkup:
     rows = []
     for c in favs:
         rows.append([
-            types.InlineKeyboardButton(text=f"📌 {c['name']}", callback_data=f"favset:{c['id']}"),
-            types.InlineKeyboardButton(text="🗑", callback_data=f"favdel:{c['id']}"),
+            types.InlineKeyboardButton(text=f"📌 {c['name']}", callback_data=CityCB(action="favset", cid=c["id"]).pack()),
+            types.InlineKeyboardButton(text="🗑", callback_data=CityCB(action="favdel", cid=c["id"]).pack()),
         ])
     return types.InlineKeyboardMarkup(inline_keyboard=rows or [[types.InlineKeyboardButton(text="(пусто)", callback_data="noop")]])
 
+def weather_icons_kb(daily: dict, days: int) -> types.InlineKeyboardMarkup:
+    # одна кнопка-иконка на день — весь прогноз уходит одним сообщением
+    rows = []
+    for date, code in zip(daily["time"][:days], daily["weathercode"][:days]):
+        rows.append([types.InlineKeyboardButton(text=f"{date} 🖼", url=f"https://open-meteo.com/assets/icons/{code}.svg")])
+    return types.InlineKeyboardMarkup(inline_keyboard=rows)
+
 def current_actions_kb(is_fav: bool) -> types.InlineKeyboardMarkup:
     btn = "⭐ В избранное" if not is_fav else "✅ Уже в избранном"
     cb = "addfav" if not is_fav else "noop"
@@ -181,26 +432,70 @@ def current_actions_kb(is_fav: bool) -> types.InlineKeyboardMarkup:
     ])
 
 
+# -------------------- Throttling --------------------
+# Telegram режет бота на ~30 сообщений/с. Лимитер стоит на исходящих запросах сессии бота:
+# отправка и правка сообщений проходят через общий leaky bucket не чаще RATE_LIMIT в секунду,
+# остальные вызовы (getUpdates, answerCallbackQuery, sendChatAction) идут без задержки.
+# Замок намеренно держится на время sleep: бакет один на весь бот, и следующий запрос
+# должен встать в очередь за уже ожидающим, а не рассчитать свой слот параллельно.
+RATE_LIMIT = 30
+THROTTLED_METHODS = (SendMessage, EditMessageText, EditMessageReplyMarkup)
+
+class ThrottleMiddleware(BaseRequestMiddleware):
+    def __init__(self, rate: int = RATE_LIMIT):
+        self._interval = 1 / rate
+        self._next = 0.0
+        # создаётся при первом запросе: на Python < 3.10 замок привязывается к текущему циклу
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ) -> Response:
+        if isinstance(method, THROTTLED_METHODS):
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                now = asyncio.get_running_loop().time()
+                if self._next > now:
+                    await asyncio.sleep(self._next - now)
+                self._next = max(now, self._next) + self._interval
+        return await make_request(bot, method)
+
+
 # -------------------- Bot --------------------
+MESSAGE_LIMIT = 4096
+
 bot = Bot(BOT_TOKEN)
+bot.session.middleware(ThrottleMiddleware())
 dp = Dispatcher()
 
-# cache for last city search results per user (to map callback id -> city)
-LAST_SEARCH: Dict[int, Dict[str, City]] = {}
+# обработчики прогнозов: пока идёт запрос к Open-Meteo, пользователь видит «печатает…».
+# Отдельный роутер, потому что ChatActionMiddleware шлёт действие для всех своих сообщений.
+weather = Router()
+weather.message.middleware(ChatActionMiddleware())
+dp.include_router(weather)
+
+# cache for last city search results per user (to map callback id -> city);
+# bounded + TTL so idle users don't pin their results forever
+LAST_SEARCH: TTLCache = TTLCache(maxsize=10_000, ttl=600)
 
 @dp.message(Command("start"))
 async def cmd_start(m: types.Message):
     get_user(m.from_user.id)
-    await m.answer("Готово ✅ Выбирай кнопку:", reply_markup=main_kb())
+    await m.answer("Готово ✅ Выбирай кнопку:", reply_markup=MAIN_KB)
 
 @dp.message(Command("help"))
 async def cmd_help(m: types.Message):
     await m.answer(
         "Команды:\n"
         "/start — меню\n"
-        "/help — помощь\n\n"
+        "/help — помощь\n"
+        "/favweather — погода на неделю по всем избранным\n\n"
         "Кнопки: выбрать город, геолокация, прогноз на неделю/«месяц», избранные.",
-        reply_markup=main_kb()
+        reply_markup=MAIN_KB
     )
 
 @dp.message(F.text == "🏙 Выбрать город")
@@ -214,7 +509,7 @@ async def city_name_received(m: types.Message, state: FSMContext):
     if not name:
         return await m.answer("Напиши название города текстом 🙂")
 
-    cities = await geo_search(name, limit=5)
+    cities = await geo_search_cached(name, limit=5)
     if not cities:
         return await m.answer("Не нашёл 😅 Попробуй другое написание.")
 
@@ -222,10 +517,10 @@ async def city_name_received(m: types.Message, state: FSMContext):
     await state.clear()
     await m.answer("Выбери точный вариант:", reply_markup=cities_inline_kb(cities))
 
-@dp.callback_query(F.data.startswith("pick:"))
-async def pick_city_cb(cq: types.CallbackQuery):
+@dp.callback_query(CityCB.filter(F.action == "pick"))
+async def pick_city_cb(cq: types.CallbackQuery, callback_data: CityCB):
     user_id = cq.from_user.id
-    cid = cq.data.split(":", 1)[1]
+    cid = callback_data.cid
     city = (LAST_SEARCH.get(user_id) or {}).get(cid)
 
     if not city:
@@ -240,8 +535,7 @@ async def pick_city_cb(cq: types.CallbackQuery):
     }
     set_current(user_id, city_dict)
 
-    u = get_user(user_id)
-    is_fav = any(c["id"] == city_dict["id"] for c in u["favorites"])
+    is_fav = city_dict["id"] in fav_ids(user_id)
 
     await cq.message.edit_text(
         f"✅ Выбран город: {city_dict['name']}",
@@ -266,9 +560,9 @@ async def favs(m: types.Message):
     favs = u.get("favorites", [])
     await m.answer("⭐ Избранные города:", reply_markup=fav_inline_kb(favs))
 
-@dp.callback_query(F.data.startswith("favset:"))
-async def fav_set(cq: types.CallbackQuery):
-    cid = cq.data.split(":", 1)[1]
+@dp.callback_query(CityCB.filter(F.action == "favset"))
+async def fav_set(cq: types.CallbackQuery, callback_data: CityCB):
+    cid = callback_data.cid
     u = get_user(cq.from_user.id)
     city = next((c for c in u.get("favorites", []) if c["id"] == cid), None)
     if not city:
@@ -278,9 +572,9 @@ async def fav_set(cq: types.CallbackQuery):
     await cq.answer("Текущий город выбран ✅")
     await cq.message.edit_text(f"✅ Текущий город: {city['name']}")
 
-@dp.callback_query(F.data.startswith("favdel:"))
-async def fav_del(cq: types.CallbackQuery):
-    cid = cq.data.split(":", 1)[1]
+@dp.callback_query(CityCB.filter(F.action == "favdel"))
+async def fav_del(cq: types.CallbackQuery, callback_data: CityCB):
+    cid = callback_data.cid
     remove_fav(cq.from_user.id, cid)
     u = get_user(cq.from_user.id)
     await cq.answer("Удалено 🗑")
@@ -290,6 +584,12 @@ async def fav_del(cq: types.CallbackQuery):
 async def noop(cq: types.CallbackQuery):
     await cq.answer()
 
+# регистрируется последним: старые кнопки (pick:/favset:/favdel: до CityCB) и прочие
+# неизвестные колбэки получают ответ, иначе у клиента бесконечно крутится индикатор
+@dp.callback_query()
+async def stale_cb(cq: types.CallbackQuery):
+    await cq.answer("Список устарел. Открой меню заново.")
+
 @dp.message(F.location)
 async def got_location(m: types.Message):
     lat = m.location.latitude
@@ -308,42 +608,87 @@ async def send_weather(m: types.Message, want_days: int):
     u = get_user(m.from_user.id)
     cur = u.get("current")
     if not cur:
-        await m.answer("Сначала выбери город 🏙 или отправь геолокацию 📍", reply_markup=main_kb())
+        await m.answer("Сначала выбери город 🏙 или отправь геолокацию 📍", reply_markup=MAIN_KB)
         return
 
-    data = await forecast_daily(cur["lat"], cur["lon"], want_days)
+    data = await forecast_daily_cached(cur["lat"], cur["lon"], want_days)
     # реальное количество дней (Open-Meteo ограничит до 16)
     real_days = min(want_days, 16)
     text = format_daily(cur["name"], data, want_days=want_days, real_days=real_days)
-    
-    # Отправляем иконки как изображения
-    for i in range(real_days):
-        weather_code = data["daily"]["weathercode"][i]
-        weather_icon = f"https://open-meteo.com/assets/icons/{weather_code}.svg"
-        await m.answer(text, reply_markup=types.InlineKeyboardMarkup().add(
-            types.InlineKeyboardButton(text="🖼️ Погода", url=weather_icon)
-        ))
-
-@dp.message(F.text == "🗓 Погода на неделю")
+    await m.answer(text, reply_markup=weather_icons_kb(data["daily"], real_days))
+
+@weather.message(F.text == "🗓 Погода на неделю", flags={"chat_action": "typing"})
 async def week(m: types.Message):
     await send_weather(m, want_days=7)
 
-@dp.message(F.text == "📅 Погода на месяц")
+@weather.message(F.text == "📅 Погода на месяц", flags={"chat_action": "typing"})
 async def month(m: types.Message):
     # “месяц” показываем максимум доступных дней (до 16) и предупреждаем
     await send_weather(m, want_days=30)
 
+@weather.message(Command("favweather"), flags={"chat_action": "typing"})
+async def fav_weather(m: types.Message):
+    favs = get_user(m.from_user.id).get("favorites", [])
+    if not favs:
+        await m.answer("Избранных городов пока нет ⭐", reply_markup=MAIN_KB)
+        return
+
+    results = await forecast_many(favs, 7)
+    blocks = []
+    for c, data in zip(favs, results):
+        # BaseException: gather может вернуть и CancelledError
+        if isinstance(data, BaseException):
+            log.warning("forecast for %s failed", c["name"], exc_info=data)
+            blocks.append(f"📍 {c['name']}\n⚠️ Не удалось получить прогноз.")
+        else:
+            blocks.append(format_daily(c["name"], data, want_days=7, real_days=7))
+
+    # одно сообщение на всё; делим только по лимиту Telegram на длину текста
+    chunk = ""
+    for block in blocks:
+        if chunk and len(chunk) + 2 + len(block) > MESSAGE_LIMIT:
+            await m.answer(chunk)
+            chunk = ""
+        chunk = f"{chunk}\n\n{block}" if chunk else block
+    await m.answer(chunk)
+
 @dp.message(F.text == "📍 Отправить геолокацию")
 async def ask_location(m: types.Message):
-    await m.answer("Нажми кнопку отправки локации (Telegram спросит разрешение).", reply_markup=main_kb())
+    await m.answer("Нажми кнопку отправки локации (Telegram спросит разрешение).", reply_markup=MAIN_KB)
 
 
 async def main():
-    await dp.start_polling(bot)
-
-if __name__ == "__main__":
-    asyncio.run(main())
-
+    global HTTP, _LOG, _DIRTY, _save_lock
+    _DIRTY = asyncio.Event()
+    _save_lock = asyncio.Lock()
+    SHARDS[:] = await to_thread(load_data)
+    _LOG = await to_thread(_open_log)
+    HTTP = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=20),
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+    )
+    tasks = [asyncio.create_task(flusher()), asyncio.create_task(compactor())]
+    try:
+        await dp.start_polling(bot)
+    finally:
+        for t in tasks:
+            t.cancel()
+        # при остановке сразу пишем снимок, чтобы следующий старт не проигрывал журнал
+        await compact()
+        await to_thread(_close_synced, _LOG)
+        await HTTP.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop быстрее стандартного цикла на сетевой нагрузке; под Windows его нет
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        if sys.version_info >= (3, 11):
+            with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                runner.run(main())
+        else:
+            # asyncio.Runner появился только в 3.11
+            uvloop.install()
+            asyncio.run(main())